@@ -0,0 +1,55 @@
+"""
+This module contains the kernel used to interpolate nodes along OSM ways, JIT compiled with Numba.
+It is used when the AOT compiled `map_reader_native` module (see build_native.py) is not available
+
+Author: Chris Harris
+"""
+
+import numpy as np
+
+from numba import njit, prange
+
+def interpolate_ways(way_starts: np.ndarray, way_lengths: np.ndarray, lats: np.ndarray,
+                     lons: np.ndarray, dists: np.ndarray,
+                     step: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Add points between consecutive way coordinates so that no two points are more than `step`
+    apart, where `dists` holds the distance between each coordinate and the next one.
+
+    The coordinates of every way are concatenated in `lats`/`lons`, with way `w` occupying
+    `way_lengths[w]` entries from `way_starts[w]`. Returns the interpolated lats/lons (in the same
+    way order) and the position of each original coordinate in them, with the total number of
+    interpolated points appended
+    """
+    n_ways = len(way_starts)
+    n_points = len(lats)
+
+    # number of points (itself plus any additional ones) each coordinate contributes
+    n_divisions = np.ones(n_points, dtype=np.int64)
+    for w in prange(n_ways):
+        for i in range(way_starts[w], way_starts[w] + way_lengths[w] - 1):
+            n_divisions[i] = int(dists[i] // step) + 1
+
+    # offsets are computed serially so each way writes to its own disjoint output range
+    original_positions = np.zeros(n_points + 1, dtype=np.int64)
+    original_positions[1:] = np.cumsum(n_divisions)
+
+    interpolated_lats = np.empty(original_positions[-1], dtype=np.float64)
+    interpolated_lons = np.empty(original_positions[-1], dtype=np.float64)
+    for w in prange(n_ways):
+        for i in range(way_starts[w], way_starts[w] + way_lengths[w]):
+            pos = original_positions[i]
+            interpolated_lats[pos] = lats[i]
+            interpolated_lons[pos] = lons[i]
+            for k in range(1, n_divisions[i]):
+                fraction = k / n_divisions[i]
+                interpolated_lats[pos + k] = lats[i] + fraction * (lats[i + 1] - lats[i])
+                interpolated_lons[pos + k] = lons[i] + fraction * (lons[i + 1] - lons[i])
+
+    return interpolated_lats, interpolated_lons, original_positions
+
+interp_ways = njit(cache=True, fastmath=True, parallel=True)(interpolate_ways)
+
+# pay the JIT compilation cost up front rather than on the first call
+interp_ways(np.zeros(1, dtype=np.int64), np.full(1, 2, dtype=np.int64),
+            np.zeros(2), np.zeros(2), np.zeros(1), 1.0)
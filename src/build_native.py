@@ -0,0 +1,21 @@
+"""
+This module AOT compiles the way interpolation kernel into the `map_reader_native` extension
+module, so that map_reader does not need to JIT compile it on first use.
+
+Usage: python build_native.py
+
+Author: Chris Harris
+"""
+
+from numba.pycc import CC
+
+from _interp_jit import interpolate_ways
+
+cc = CC("map_reader_native")
+cc.verbose = True
+
+cc.export("interp_ways",
+          "Tuple((f8[:], f8[:], i8[:]))(i8[:], i8[:], f8[:], f8[:], f8[:], f8)")(interpolate_ways)
+
+if __name__ == "__main__":
+    cc.compile()
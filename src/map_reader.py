@@ -5,39 +5,76 @@ OpenStreetMap (OSM) data
 Author: Chris Harris
 """
 
-import json
+import hashlib
+import os
+import time
 
-from math import sqrt
+from operator import itemgetter
 from pathlib import Path
-from random import randint
 
 import matplotlib.pyplot as plt
 import numpy as np
+import orjson
 import requests
 
+from matplotlib.collections import LineCollection
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# use the AOT compiled kernel if it has been built (see build_native.py), otherwise JIT compile it
+try:
+    from map_reader_native import interp_ways
+except ImportError:
+    from _interp_jit import interp_ways
+
+EARTH_RADIUS_METRES = 6_371_000
+
 class MapReader:
     """
     Class handles accessing OpenStreetMap data and returning relevant road/street data
     """
+    _HIGHWAY_QUERY_TEMPLATE = (
+        '[out:json];'
+        '(node["highway"]({s},{w},{n},{e});'
+        'way["highway"]({s},{w},{n},{e});'
+        '{relations});'
+        'out body;>;out skel qt;'
+    )
+    _HIGHWAY_RELATION_TEMPLATE = 'relation["highway"]({s},{w},{n},{e});'
+
+    __slots__ = ("_overpass_url", "_step_size", "_overpass_result", "_lats", "_lons",
+                 "_id_to_index", "_next_synth_id", "_save_location", "_session")
+
     def __init__(self):
-        self._overpass_url = "http://overpass-api.de/api/interpreter"
-        self._step_size = 0.0001
+        self._overpass_url = "https://overpass-api.de/api/interpreter"
+        self._step_size = 10
         self._overpass_result = {}
-        self._node_coordinates = {}
+        self._lats = np.empty(0, dtype=np.float64)
+        self._lons = np.empty(0, dtype=np.float64)
+        self._id_to_index = {}
+        # ids given to interpolated nodes, kept above any id already in the result
+        self._next_synth_id = 10**18
         self._save_location = Path.home() / "strava-art-generator" / "osm-data"
 
+        # reuse connections to Overpass and back off when rate limited
+        retry = Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 502, 504])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
     # Getter/setters
     @property
     def step_size(self) -> float:
         """
-        Get the step size to be used between consecutive nodes
+        Get the step size (in metres) to be used between consecutive nodes
         """
         return self._step_size
 
     @step_size.setter
     def step_size(self, new_step_size: float) -> None:
         """
-        Set the step size to be used between consecutive nodes
+        Set the step size (in metres) to be used between consecutive nodes
         """
         self._step_size = new_step_size
 
@@ -58,40 +95,56 @@ class MapReader:
     # Public methods
     def get_highway_data_from_bbox(self, south_latitude: float, west_longitude: float,
                                     north_latitude: float, east_longitude: float,
-                                    write_to_file: bool=False) -> None:
-        """
-        Queries all OSM nodes, ways and relations within the box defined by the latitudes/longitudes
+                                    write_to_file: bool=False,
+                                    max_age: float=7 * 24 * 60 * 60,
+                                    include_relations: bool=False) -> None:
         """
-        roi = f"({south_latitude}, {west_longitude}, {north_latitude}, {east_longitude})"
-        feature = "highway"
-
-        query = f"""
-        [out:json];
-        (
-        node["{feature}"]
-            {roi};
-        way["{feature}"]
-            {roi};
-        relation["{feature}"]
-            {roi};
-        );
-        out body;
-        >;
-        out skel qt;
+        Queries all OSM nodes and ways (and optionally relations) within the box defined by the
+        latitudes/longitudes. Highways are rarely tagged on relations, so these are skipped by
+        default
+
+        Results are cached in `save_location`, and a cached result is reused if it is less than
+        `max_age` seconds old
         """
-        self._overpass_result = self._query_overpass(query)
+        roi = {"s": south_latitude, "w": west_longitude, "n": north_latitude, "e": east_longitude}
+        relations = self._HIGHWAY_RELATION_TEMPLATE.format(**roi) if include_relations else ""
+        query = self._HIGHWAY_QUERY_TEMPLATE.format(relations=relations, **roi)
+
+        query_hash = hashlib.blake2b(query.encode(), digest_size=8).hexdigest()
+        cache_location = Path(self.save_location) / f"cache-{query_hash}.json"
+        cached_result = None
+        if cache_location.exists() and time.time() - cache_location.stat().st_mtime < max_age:
+            try:
+                with open(cache_location, "rb") as cache_file:
+                    cached_result = orjson.loads(cache_file.read())
+            except orjson.JSONDecodeError:
+                cache_location.unlink(missing_ok=True)
+
+        if cached_result is not None:
+            self._overpass_result = cached_result
+        else:
+            self._overpass_result = self._query_overpass(query)
+            # a remark means Overpass hit a runtime error or timeout, so the result may be partial
+            if "remark" not in self._overpass_result:
+                cache_location.parent.mkdir(parents=True, exist_ok=True)
+                # write to a temporary file first so an interrupted write never leaves a
+                # truncated cache behind
+                temp_location = cache_location.with_name(cache_location.name + ".tmp")
+                with open(temp_location, "wb") as cache_file:
+                    cache_file.write(orjson.dumps(self._overpass_result))
+                os.replace(temp_location, cache_location)
 
         if write_to_file:
-            json_object = json.dumps(self._overpass_result, indent=4)
-            with open(self.save_location / "osm-output.json", "w", encoding="utf8") as output:
+            json_object = orjson.dumps(self._overpass_result, option=orjson.OPT_INDENT_2)
+            with open(self.save_location / "osm-output.json", "wb") as output:
                 output.write(json_object)
 
     def get_highway_data_from_file(self, file_location: Path) -> None:
         """
         Read json formatted overpass result from saved file
         """
-        with open(file_location, "r", encoding="utf8") as input_file:
-            self._overpass_result = json.load(input_file)
+        with open(file_location, "rb") as input_file:
+            self._overpass_result = orjson.loads(input_file.read())
 
     def interpolate_nodes(self, write_to_file: bool=False) -> None:
         """
@@ -101,156 +154,162 @@ class MapReader:
 
         This method adds additional nodes space `_step_size` apart to fill in straight ways.
         """
-        modified_overpass_result = self._overpass_result.copy()
-
-        for element in self._overpass_result["elements"]:
-            if element["type"] != "way":
-                continue
-
-            way_nodes = element["nodes"]
-            way_id = element["id"]
-            new_way_nodes = way_nodes.copy()
-
-            for idx, curr_node in enumerate(way_nodes):
-                new_way_nodes.append(curr_node)
-
-                if idx == len(way_nodes) - 1:
-                    continue
-
-                next_node = way_nodes[idx + 1]
-                next_node_coord = self._node_coordinates.get(next_node, None)
-                curr_node_coord = self._node_coordinates.get(curr_node, None)
-
-                if not curr_node_coord:
-                    curr_node_data = self._get_node_lat_lon(curr_node)["elements"][0]
-                    curr_node_coord = [curr_node_data["lat"], curr_node_data["lon"]]
-
-                if not next_node_coord:
-                    next_node_data = self._get_node_lat_lon(next_node)["elements"][0]
-                    next_node_coord = [next_node_data["lat"], next_node_data["lon"]]
-
-                dist = distance(curr_node_coord, next_node_coord)
-
-                if dist > self.step_size:
-                    n_divisions = int((dist // self.step_size) + 1)
-                    additional_nodes_lat = np.linspace(curr_node_coord[0],
-                                                       next_node_coord[0],
-                                                       n_divisions)
-                    additional_nodes_lon = np.linspace(curr_node_coord[1],
-                                                       next_node_coord[1],
-                                                       n_divisions)
-                    additional_nodes = zip(additional_nodes_lat, additional_nodes_lon)
-                    # not a perfect method to get unique ids, but unlikely for overlaps
-                    random_ids = []
-                    n_digits = 10
-                    for _n in range(len(additional_nodes_lat)):
-                        random_ids.append(randint(10**(n_digits - 1), 10**(n_digits) - 1))
-                    additional_node_ids = [curr_node + random_id \
-                                           for random_id in random_ids]
-
-                    for additional_node_id, additional_node in zip(additional_node_ids,
-                                                                   additional_nodes):
-                        new_node = {
-                            "type": "node",
-                            "id": additional_node_id,
-                            "lat": additional_node[0],
-                            "lon": additional_node[1]
-                        }
-                        # add new node to end of elements
-                        modified_overpass_result["elements"].append(new_node)
-
-                        # add new node id to way
-                        new_way_nodes.append(additional_node_id)
-
-                        # add new node to _node_coordinates
-                        self._node_coordinates[additional_node_id] = tuple([new_node["lat"],
-                                                                            new_node["lon"]])
-
-            new_way_nodes.append(way_nodes[-1]) # manually added since it is skipped in the loop
+        elements = self._overpass_result["elements"]
+        id_to_index = self._id_to_index
+
+        ways = [element for element in elements if element["type"] == "way"]
+        missing_node_ids = {node_id for way in ways for node_id in way["nodes"]
+                            if node_id not in id_to_index}
+        if missing_node_ids:
+            self._bulk_get_node_lat_lon(list(missing_node_ids))
+
+        # interpolate every way in one go on the concatenated way coordinates
+        way_lengths = np.fromiter((len(way["nodes"]) for way in ways), dtype=np.int64,
+                                  count=len(ways))
+        way_starts = np.cumsum(way_lengths) - way_lengths
+        way_nodes = [node_id for way in ways for node_id in way["nodes"]]
+        idx = np.fromiter(map(id_to_index.get, way_nodes), dtype=np.int64,
+                          count=len(way_nodes))
+        way_lats = self._lats[idx]
+        way_lons = self._lons[idx]
+        # distances between the last node of a way and the first of the next are never used
+        dists = haversine_np(way_lats[:-1], way_lons[:-1], way_lats[1:], way_lons[1:])
+        interpolated_lats, interpolated_lons, original_positions = \
+            interp_ways(way_starts, way_lengths, way_lats, way_lons, dists, float(self.step_size))
+
+        n_total_additional = len(interpolated_lats) - len(way_nodes)
+        if n_total_additional > 0:
+            is_additional = np.ones(len(interpolated_lats), dtype=bool)
+            is_additional[original_positions[:-1]] = False
+            # results loaded from file may already contain previously interpolated nodes
+            self._next_synth_id = max(self._next_synth_id,
+                                      max(element["id"] for element in elements) + 1)
+            new_node_ids = np.arange(self._next_synth_id,
+                                     self._next_synth_id + n_total_additional,
+                                     dtype=np.int64)
+            self._next_synth_id += n_total_additional
+            new_node_lats = interpolated_lats[is_additional]
+            new_node_lons = interpolated_lons[is_additional]
+
+            new_way_nodes = np.empty(len(interpolated_lats), dtype=np.int64)
+            new_way_nodes[~is_additional] = way_nodes
+            new_way_nodes[is_additional] = new_node_ids
+            new_way_nodes = new_way_nodes.tolist()
 
             # assign new way nodes to result
-            for element in modified_overpass_result["elements"]:
-                if element["id"] == way_id:
-                    element["nodes"] = new_way_nodes
-
-        self._overpass_result = modified_overpass_result
+            way_out_starts = original_positions[way_starts].tolist()
+            way_out_ends = original_positions[way_starts + way_lengths].tolist()
+            for way, start, end in zip(ways, way_out_starts, way_out_ends):
+                way["nodes"] = new_way_nodes[start:end]
+
+            # add all new nodes to end of elements and the node coordinates in one batch
+            new_node_ids = new_node_ids.tolist()
+            elements.extend([{
+                "type": "node",
+                "id": node_id,
+                "lat": lat,
+                "lon": lon
+            } for node_id, lat, lon in zip(new_node_ids, new_node_lats.tolist(),
+                                           new_node_lons.tolist())])
+            self._add_node_coordinates(new_node_ids, new_node_lats, new_node_lons)
 
         if write_to_file:
-            json_object = json.dumps(self._overpass_result, indent=4)
-            with open(self.save_location / "osm-interpolated-output.json", "w", encoding="utf8") \
-                as output:
+            json_object = orjson.dumps(self._overpass_result, option=orjson.OPT_INDENT_2)
+            with open(self.save_location / "osm-interpolated-output.json", "wb") as output:
                 output.write(json_object)
 
     def plot_response_data(self) -> None:
         """
-        Plot the lat/long of each node, nodes in ways and nodes in relations
+        Plot each way, along with the lat/long of each node, nodes in ways and nodes in relations
         """
-        lat_lon = []
-        for _node, pair in self._node_coordinates.items():
-            lat_lon.append(pair)
-        lat_lon = np.array(lat_lon)
-        latitudes, longitudes = lat_lon[:, 0], lat_lon[:, 1]
-
-        plt.plot(longitudes, latitudes, ".")
-        plt.xlabel("Longitude")
-        plt.ylabel("Latitude")
-        plt.axis("equal")
+        segments = []
+        for element in self._overpass_result["elements"]:
+            if element["type"] != "way":
+                continue
+            idx = [self._id_to_index[node_id] for node_id in element["nodes"]
+                   if node_id in self._id_to_index]
+            segments.append(np.column_stack([self._lons[idx], self._lats[idx]]))
+
+        _fig, ax = plt.subplots()
+        ax.add_collection(LineCollection(segments, linewidths=0.5))
+        ax.scatter(self._lons, self._lats, s=1, rasterized=True)
+        ax.autoscale()
+        ax.set_aspect("equal")
+        ax.set_xlabel("Longitude")
+        ax.set_ylabel("Latitude")
         plt.show()
 
     def extract_coordinates(self) -> None:
         """
         Extract the lat/lon of each node, nodes in ways and nodes in relations from the query result
         """
-
-        for element in self._overpass_result["elements"]:
-            if element["type"] == "node":
-                node_id = element["id"]
-                lat = element["lat"]
-                lon = element["lon"]
-                self._node_coordinates[node_id] = tuple([lat, lon])
+        nodes = [element for element in self._overpass_result["elements"]
+                 if element["type"] == "node"]
+        n_nodes = len(nodes)
+        node_ids = np.fromiter(map(itemgetter("id"), nodes), dtype=np.int64, count=n_nodes)
+        lats = np.fromiter(map(itemgetter("lat"), nodes), dtype=np.float64, count=n_nodes)
+        lons = np.fromiter(map(itemgetter("lon"), nodes), dtype=np.float64, count=n_nodes)
+
+        # nodes can be listed twice, once with tags and again as part of a way
+        _unique_ids, first_idx = np.unique(node_ids, return_index=True)
+        first_idx.sort()
+        self._lats = lats[first_idx]
+        self._lons = lons[first_idx]
+        self._id_to_index = dict(zip(node_ids[first_idx].tolist(), range(len(first_idx))))
 
     # Private methods
     def _query_overpass(self, query: str, timeout: int=30) -> dict:
         """
         Send query to Overpass API and return json formatted result
         """
-        response = requests.get(self._overpass_url, params={"data": query}, timeout=timeout)
-        response_data = response.json()
+        response = self._session.get(self._overpass_url, params={"data": query}, timeout=timeout)
+        response.raise_for_status()
+        response_data = orjson.loads(response.content)
         return response_data
 
-    def _get_node_lat_lon(self, node_id: int) -> dict:
+    def _bulk_get_node_lat_lon(self, node_ids: list[int], batch_size: int=500) -> None:
         """
-        Get the lat, lon for a node given its id
+        Get the lat, lon for each node given their ids and add them to the stored node coordinates.
+        Nodes are requested `batch_size` at a time to keep the query url a reasonable length
         """
-        query = f"""
-        [out:json];
-        (
-        node({node_id});
-        );
-        (._;>;);
-        out;"""
-        return self._query_overpass(query)
-
-def distance(a_lat_lon: tuple[float], b_lat_lon: tuple[float]) -> float:
-    """
-    Calculate the distance between 2 points
-    """
-    a_x, a_y = a_lat_lon
-    b_x, b_y = b_lat_lon
-    return sqrt((a_x - b_x)**2 + (a_y - b_y)**2)
+        for start in range(0, len(node_ids), batch_size):
+            batch_ids = ",".join(map(str, node_ids[start:start + batch_size]))
+            query = f"""
+            [out:json];
+            node(id:{batch_ids});
+            out;"""
+            nodes = self._query_overpass(query)["elements"]
+            self._add_node_coordinates([node["id"] for node in nodes],
+                                       [node["lat"] for node in nodes],
+                                       [node["lon"] for node in nodes])
+
+    def _add_node_coordinates(self, node_ids: list[int], lats: list[float],
+                              lons: list[float]) -> None:
+        """
+        Add the lat, lon of each node to the stored node coordinates
+        """
+        offset = len(self._lats)
+        self._id_to_index.update(zip(node_ids, range(offset, offset + len(node_ids))))
+        self._lats = np.concatenate([self._lats, np.asarray(lats, dtype=np.float64)])
+        self._lons = np.concatenate([self._lons, np.asarray(lons, dtype=np.float64)])
 
-def metres_to_degrees(metres: float) -> float:
+def haversine_np(lat1: np.ndarray, lon1: np.ndarray,
+                 lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
     """
-    An **approximate** conversion between metres to lat/lon degrees
-    e.g. Helpful if calculating a change in 20m results in a change in x degrees
+    Calculate the great-circle distance (in metres) between each pair of points
 
-    Source: https://www.usna.edu/Users/oceano/pguth/md_help/html/approx_equivalents.htm
+    Source: https://en.wikipedia.org/wiki/Haversine_formula
     """
-    return metres / (111*10**3)
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d_lat = lat2 - lat1
+    d_lon = lon2 - lon1
+    a = np.sin(d_lat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS_METRES * c
 
 if __name__ == "__main__":
     reader = MapReader()
-    reader.step_size = metres_to_degrees(25)
+    reader.step_size = 25
     reader.get_highway_data_from_bbox(-33.8338,150.9249,-33.8148,150.9643)
     reader.extract_coordinates()
     reader.interpolate_nodes()